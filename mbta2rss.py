@@ -5,8 +5,26 @@
 # Copyright: Copyright (C) 2019-2021 Ben O'Neill <benoneill.xyz>. Licensed under
 # the GNU GPL v3.
 
-import argparse, os, requests, html
-from datetime import datetime
+import argparse, os, sys, requests
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from threading import RLock
+from time import monotonic
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from xml.sax.saxutils import XMLGenerator
+
+try:
+    # optional: lets alerts be parsed incrementally as the response arrives
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    # optional: faster JSON parsing of API responses
+    from orjson import loads
+except ImportError:
+    from json import loads
 
 API_URL = 'https://api-v3.mbta.com/'
 API_KEY = ''
@@ -16,6 +34,33 @@ DEFAULT_LANG = 'en_us'
 DEFAULT_URL = 'https://github.com/darklands1/mbta-rss'
 DEFAULT_DATATYPE = 'alerts'
 
+# characters left unescaped in query strings (filter brackets, route lists)
+QUERY_SAFE = '[],'
+
+# translation table escaping text for inclusion in HTML element content
+_HTML_ESC = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+# (connect, read) timeouts in seconds for API calls
+API_TIMEOUT = (3, 30)
+
+# maximum number of concurrent API requests (kept within the connection pool size)
+MAX_WORKERS = 8
+
+# seconds an API response is served from the in-memory cache. Stop lists are
+# always cached; alerts are only cached when ijson is not installed, since
+# streamed alerts are never held in memory as a whole
+CACHE_TTL = 30
+
+# Shared session so keep-alive connections to the API are reused between calls
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# API responses by request string, as (time retrieved, JSON output)
+_CACHE = {}
+# requests currently being fetched, so concurrent identical ones share a result
+_INFLIGHT = {}
+_CACHE_LOCK = RLock()
+
 """
 Driver for printing Markdown alert output. This formats the data from the API
 to be semi-neatly displayed in basic Markdown
@@ -30,17 +75,16 @@ class MarkdownAlertDriver:
     
     """ Stuff to print before the main content """
     def print_start(self):
-        print('# ' + title)
-        print(desc)
+        sys.stdout.write(f"# {self.title}\n{self.desc}\n")
 
     """ Format and print alert """
-    def print_item(self, header, long_header='', desc='', effect='', date='', categories=[], guid=''):
-        print('## ' + header + ' (added ' + date + ')')
-        print(long_header + '\n\n' + desc.replace('\n', '\n\n') + '\n\n')
+    def print_item(self, header, long_header='', desc='', effect='', date='', categories=(), guid=''):
+        desc_expanded = desc.replace('\n', '\n\n')
+        sys.stdout.write(f"## {header} (added {date})\n{long_header}\n\n{desc_expanded}\n\n\n")
 
-    """ Stuff to print after the main content (empty in this case but defined for consistency) """
+    """ Stuff to print after the main content """
     def print_end(self):
-        pass
+        sys.stdout.flush()
 
 """
 Driver for printing RSS alert output. This formats the data from the API
@@ -48,88 +92,188 @@ to be semi-neatly displayed as an RSS feed.
 """
 class RSSAlertDriver:
     def __init__(self, title=DEFAULT_TITLE, desc=DEFAULT_DESC,
-            lang=DEFAULT_LANG, url=DEFAULT_URL):
+            lang=DEFAULT_LANG, url=DEFAULT_URL, out=None):
         self.title = title
         self.desc = desc
         self.lang = lang
         self.url = url
-    
+        # XML is written to out (stdout by default, sharing its buffer with
+        # anything print()ed so output stays in order) and flushed once in
+        # print_end(); the generator handles escaping of text content
+        if out == None:
+            out = sys.stdout
+        self._out = out
+        self._xml = XMLGenerator(self._out, 'utf-8', short_empty_elements=True)
+
+    """ Write a single element containing text, followed by a newline """
+    def write_element(self, name, text):
+        self._xml.startElement(name, {})
+        self._xml.characters(text)
+        self._xml.endElement(name)
+        self._xml.ignorableWhitespace('\n')
+
+    """ Open an element containing other elements, followed by a newline """
+    def open_element(self, name, attrs=None):
+        self._xml.startElement(name, attrs or {})
+        self._xml.ignorableWhitespace('\n')
+
+    """ Close an element opened with open_element, followed by a newline """
+    def close_element(self, name):
+        self._xml.endElement(name)
+        self._xml.ignorableWhitespace('\n')
+
     """ Stuff to print before the main content """
     def print_start(self):
-        print('<?xml version="1.0" encoding="utf-8"?>')
-        print('<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">')
-        print('<channel>')
-        print('<title>' + self.title + '</title>')
-        print('<description>' + self.desc + '</description>')
-        print('<language>' + self.lang + '</language>')
-        print('<link>' + self.url + '</link>')
+        self._xml.startDocument()
+        self.open_element('rss', {'version': '2.0',
+            'xmlns:atom': 'http://www.w3.org/2005/Atom'})
+        self.open_element('channel')
+        self.write_element('title', self.title)
+        self.write_element('description', self.desc)
+        self.write_element('language', self.lang)
+        self.write_element('link', self.url)
 
     """ Format and print alert """
     def print_item(self, header, long_header='', desc='', effect='', date='',
-            categories=[], guid=''):
-        content = "<pre>" + html.escape(long_header) + "\n\n" + html.escape(desc) + "</pre>"
-
-        print('<item>')
-        print('<title>' + html.escape(header) + '</title>')
-        print('<description>' + content + '</description>')
-        print('<pubDate>' + date + '</pubDate>')
-        print('<guid>' + guid + '</guid>')
+            categories=(), guid=''):
+        # the description holds HTML, which is escaped again as XML text
+        content = "<pre>" + long_header.translate(_HTML_ESC) + "\n\n" + desc.translate(_HTML_ESC) + "</pre>"
+
+        self.open_element('item')
+        self.write_element('title', header)
+        self.write_element('description', content)
+        self.write_element('pubDate', date)
+        self.write_element('guid', guid)
         for category in categories:
-            print('<category>' + category + '</category>')
-        print('</item>')
+            self.write_element('category', category)
+        self.close_element('item')
 
     """ Stuff to print after the main content """
     def print_end(self):
-        print('</channel>')
-        print('</rss>')
+        self.close_element('channel')
+        self.close_element('rss')
+        self._xml.endDocument()
+        self._out.flush()
+
+""" Returns the cached JSON output for a request, or None if it has expired """
+def cache_get(req):
+    with _CACHE_LOCK:
+        entry = _CACHE.get(req)
+    if entry != None and monotonic() - entry[0] < CACHE_TTL:
+        return entry[1]
+    return None
+
+""" Caches the JSON output for a request, dropping any expired entries """
+def cache_put(req, payload):
+    now = monotonic()
+    with _CACHE_LOCK:
+        for key in [k for k, (t, _) in _CACHE.items() if now - t >= CACHE_TTL]:
+            del _CACHE[key]
+        _CACHE[req] = (now, payload)
 
 """ Sends a request to the API and return the JSON output """
 def retrieve_from_api(req):
-    return requests.get('https://api-v3.mbta.com/' + req).json()
+    payload = cache_get(req)
+    if payload != None:
+        return payload
+
+    # if the same request is already being fetched, wait for its result
+    # rather than sending it again
+    with _CACHE_LOCK:
+        payload = cache_get(req)
+        if payload != None:
+            return payload
+        future = _INFLIGHT.get(req)
+        waiting = future != None
+        if not waiting:
+            future = _INFLIGHT[req] = Future()
+    if waiting:
+        return future.result()
+
+    try:
+        resp = _SESSION.get(API_URL + req, timeout=API_TIMEOUT)
+        # error responses (e.g. rate limiting) carry no data, so fail loudly
+        resp.raise_for_status()
+        payload = loads(resp.content)
+        # only reached for successful responses, so errors are never cached
+        cache_put(req, payload)
+        future.set_result(payload)
+    except BaseException as e:
+        # resolve the future even on interrupts so waiters never hang
+        future.set_exception(e)
+        raise
+    finally:
+        with _CACHE_LOCK:
+            del _INFLIGHT[req]
+    return payload
+
+"""
+Sends a request to the API and yields each entry of the JSON output's data
+list as soon as it has been parsed. Streamed responses are neither cached
+nor shared with concurrent identical requests, so only one entry is held at
+a time (falls back to retrieve_from_api, which does both, when ijson is not
+installed)
+"""
+def stream_from_api(req):
+    if ijson == None:
+        yield from retrieve_from_api(req)['data']
+        return
+
+    with _SESSION.get(API_URL + req, timeout=API_TIMEOUT, stream=True) as resp:
+        resp.raise_for_status()
+        # let urllib3 undo any gzip encoding before ijson sees the bytes
+        resp.raw.decode_content = True
+        yield from ijson.items(resp.raw, 'data.item', use_float=True)
+
+"""
+Formats an API timestamp (YYYY-MM-DDTHH:MM:SS+HH:MM) as MM-DD-YYYY HH:MM AM/PM.
+The layout is fixed, so fields are sliced out instead of parsing a datetime.
+Results are memoized since the same alerts reappear on every refresh.
+"""
+@lru_cache(maxsize=4096)
+def _fmt_created(s):
+    hour = int(s[11:13])
+    ampm = 'AM' if hour < 12 else 'PM'
+    return f"{s[5:7]}-{s[8:10]}-{s[0:4]} {hour % 12 or 12:02d}:{s[14:16]} {ampm}"
 
 """ Facilitates conversion of alerts from the JSON API into the desired format. """
 def get_alerts(driver, route, time):
     driver.print_start()
 
-    req_str = 'alerts'
-    character = '?'
-
+    params = {}
     if time != None:
         # only list alerts in effect at a given time
-        req_str += character + 'filter[datetime]=' + time
-        character = '&'
-    if API_KEY != None:
+        params['filter[datetime]'] = time
+    if API_KEY:
         # use an API key for more requests per minute
-        req_str += character + 'api_key=' + API_KEY
-        character = '&'
+        params['api_key'] = API_KEY
     if route != None:
         # filter to certain routes
-        req_str += character + 'filter[route]=' + route
-        character = '&'
+        params['filter[route]'] = route
 
-    # retrieve API result using the formatted request
-    alerts = retrieve_from_api(req_str)
+    req_str = 'alerts'
+    if params:
+        req_str += '?' + urlencode(params, safe=QUERY_SAFE)
 
-    for alert in alerts['data']:
+    # bind per-alert calls to locals once, outside the loop
+    emit = driver.print_item
+    fmt_date = _fmt_created
+
+    # stream API result using the formatted request
+    for alert in stream_from_api(req_str):
         attributes = alert['attributes']
-        desc = ''
-        effect = ''
-        categories = [] # TODO currently unused, how to implement?
+        categories = () # TODO currently unused, how to implement?
         guid = alert['id']
 
         header = attributes['short_header'] # this should always be non-empty
         long_header = attributes['header'] # this should always be non-empty
-        dt = datetime.fromisoformat(attributes['created_at'])
-        date = dt.strftime('%m-%d-%Y %I:%M %p')
-
-        if attributes['description'] != None:
-            desc = attributes['description']
-
-        if attributes['effect'] != None:
-            effect = 'Effect: ' + attributes['effect']
+        date = fmt_date(attributes['created_at'])
+        desc = attributes.get('description') or ''
+        effect = attributes.get('effect')
+        effect = 'Effect: ' + effect if effect else ''
 
         # print using given driver
-        driver.print_item(header, long_header, desc, effect, date, categories, guid)
+        emit(header, long_header, desc, effect, date, categories, guid)
 
     driver.print_end()
 
@@ -142,12 +286,19 @@ def get_stoplist(routes):
         print("route list must be provided when listing stops")
         exit(1)
 
+    def fetch_stops(route):
+        params = {'filter[route]': route}
+        if API_KEY:
+            params['api_key'] = API_KEY
+        return retrieve_from_api('stops?' + urlencode(params, safe=QUERY_SAFE))
+
+    # fetch every route concurrently; map() keeps results in route order
+    route_list = routes.split(',')
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        results = list(ex.map(fetch_stops, route_list))
+
     driver.print_start()
-    for route in routes.split(','):
-        reqstr = 'stops?filter[route]=' + route
-        if API_KEY != None:
-            reqstr += '&api_key=' + API_KEY
-        stoplist = retrieve_from_api(reqstr)
+    for route, stoplist in zip(route_list, results):
         print("## Route: " + route)
         for stop in stoplist['data']:
             print("* " + stop['attributes']['name'])
@@ -190,6 +341,10 @@ if __name__ == '__main__':
     # calls are limited in frequency.
     API_KEY = os.getenv("API_KEY")
 
+    # Output is flushed by the driver once everything has been written, so
+    # don't flush on every line even when writing to a terminal
+    sys.stdout.reconfigure(line_buffering=False)
+
     # Check for output driver
     if outfmt == None or outfmt == 'rss':
         driver = RSSAlertDriver(title, desc, DEFAULT_LANG, url)